@@ -1,8 +1,11 @@
 from pathlib import Path
+from xml.etree import ElementTree
 
 import numpy as np
+import pytest
+import tifffile
 
-from xtiff import to_tiff
+from xtiff import TiffProfile, get_ome_xml, to_tiff
 
 
 def test_to_tiff(tmp_path: Path):
@@ -18,3 +21,85 @@ def test_to_tiff(tmp_path: Path):
         pixel_size=1.0,
         pixel_depth=2.0,
     )
+
+
+def test_to_tiff_memmap(tmp_path: Path):
+    path = tmp_path / "test.ome.tiff"
+    img = np.arange(3 * 64 * 64, dtype=np.uint16).reshape((3, 64, 64))
+    img_memmap = np.memmap(
+        tmp_path / "img.dat", dtype=img.dtype, mode="w+", shape=img.shape
+    )
+    img_memmap[:] = img
+    img_memmap.flush()
+    to_tiff(img_memmap, path)
+    assert np.array_equal(tifffile.imread(path).reshape(img.shape), img)
+
+
+def test_to_tiff_dask_data_array(tmp_path: Path):
+    xr = pytest.importorskip("xarray")
+    pytest.importorskip("dask")
+    path = tmp_path / "test.ome.tiff"
+    img = np.arange(2 * 64 * 64, dtype=np.uint16).reshape((2, 64, 64))
+    data_array = xr.DataArray(
+        img, dims=("c", "y", "x"), coords={"c": ["Channel 1", "Channel 2"]}
+    ).chunk({"c": 1})
+    to_tiff(data_array, path)
+    assert np.array_equal(tifffile.imread(path).reshape(img.shape), img)
+    with tifffile.TiffFile(path) as tiff_file:
+        assert b"Channel 1" in tiff_file.pages[0].description.encode()
+
+
+def test_to_tiff_tile(tmp_path: Path):
+    path = tmp_path / "test.ome.tiff"
+    img = np.arange(2 * 64 * 64, dtype=np.uint16).reshape((2, 64, 64))
+    to_tiff(img, path, tile=(16, 16))
+    with tifffile.TiffFile(path) as tiff_file:
+        assert tiff_file.pages[0].is_tiled
+    assert np.array_equal(tifffile.imread(path).reshape(img.shape), img)
+
+
+def test_to_tiff_memmap_tile(tmp_path: Path):
+    path = tmp_path / "test.ome.tiff"
+    img = np.arange(2 * 64 * 64, dtype=np.uint16).reshape((2, 64, 64))
+    img_memmap = np.memmap(
+        tmp_path / "img.dat", dtype=img.dtype, mode="w+", shape=img.shape
+    )
+    img_memmap[:] = img
+    img_memmap.flush()
+    to_tiff(img_memmap, path, tile=(16, 16))
+    with tifffile.TiffFile(path) as tiff_file:
+        assert tiff_file.pages[0].is_tiled
+    assert np.array_equal(tifffile.imread(path).reshape(img.shape), img)
+
+
+def test_to_tiff_description(tmp_path: Path):
+    generated_path = tmp_path / "generated.ome.tiff"
+    provided_path = tmp_path / "provided.ome.tiff"
+    img = np.zeros((1, 1, 2, 16, 16, 1), dtype=np.uint16)
+    to_tiff(img, generated_path, image_name="test", pixel_size=1.0)
+    ome_xml = get_ome_xml(img, "test", None, False, 1.0, None, interleaved=True)
+    description = ElementTree.tostring(
+        ome_xml.getroot(), encoding="utf-8", xml_declaration=True
+    )
+    to_tiff(img, provided_path, description=description)
+    with tifffile.TiffFile(generated_path) as generated_tiff_file:
+        with tifffile.TiffFile(provided_path) as provided_tiff_file:
+            assert (
+                generated_tiff_file.pages[0].description
+                == provided_tiff_file.pages[0].description
+            )
+    # str descriptions are encoded as UTF-8 (the header contains the µ character)
+    to_tiff(img, provided_path, description=description.decode("utf-8"))
+
+
+def test_to_tiff_imagej_rgb_clip(tmp_path: Path):
+    xr = pytest.importorskip("xarray")
+    path = tmp_path / "test.tiff"
+    img = np.arange(2 * 16 * 16 * 3, dtype=np.uint16).reshape((1, 1, 2, 16, 16, 3))
+    for img_or_data_array in (img, xr.DataArray(img)):
+        with pytest.warns(UserWarning, match="clipping"):
+            try:
+                to_tiff(img_or_data_array, path, profile=TiffProfile.IMAGEJ)
+            except ValueError:
+                # some tifffile versions reject RGB ImageJ hyperstacks
+                pass
@@ -3,16 +3,24 @@ from xml.etree import ElementTree
 
 import numpy as np
 
+_OME_NAMESPACE = "http://www.openmicroscopy.org/Schemas/OME/2016-06"
+_OME_SCHEMA_LOCATION = "http://www.openmicroscopy.org/Schemas/OME/2016-06/ome.xsd"
+_OME_ELEMENT_ATTRIB = {
+    "xmlns": _OME_NAMESPACE,
+    "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
+    "xsi:schemaLocation": " ".join((_OME_NAMESPACE, _OME_SCHEMA_LOCATION)),
+}
+
 OME_TYPES = {
-    np.bool_().dtype: "bool",
-    np.int8().dtype: "int8",
-    np.int16().dtype: "int16",
-    np.int32().dtype: "int32",
-    np.uint8().dtype: "uint8",
-    np.uint16().dtype: "uint16",
-    np.uint32().dtype: "uint32",
-    np.float32().dtype: "float",
-    np.float64().dtype: "double",
+    np.dtype(bool): "bool",
+    np.dtype(np.int8): "int8",
+    np.dtype(np.int16): "int16",
+    np.dtype(np.int32): "int32",
+    np.dtype(np.uint8): "uint8",
+    np.dtype(np.uint16): "uint16",
+    np.dtype(np.uint32): "uint32",
+    np.dtype(np.float32): "float",
+    np.dtype(np.float64): "double",
 }
 
 
@@ -38,16 +46,8 @@ def get_ome_xml(
         assert pixel_size > 0.0
     if pixel_depth is not None:
         assert pixel_depth > 0
-    ome_namespace = "http://www.openmicroscopy.org/Schemas/OME/2016-06"
-    ome_schema_location = "http://www.openmicroscopy.org/Schemas/OME/2016-06/ome.xsd"
-    ome_element = ElementTree.Element(
-        "OME",
-        attrib={
-            "xmlns": ome_namespace,
-            "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
-            "xsi:schemaLocation": " ".join((ome_namespace, ome_schema_location)),
-        },
-    )
+    # ElementTree.Element copies the shared attrib dict
+    ome_element = ElementTree.Element("OME", attrib=_OME_ELEMENT_ATTRIB)
     image_element = ElementTree.SubElement(
         ome_element, "Image", attrib={"ID": "Image:0"}
     )
@@ -77,11 +77,15 @@ def get_ome_xml(
     if pixel_depth is not None:
         pixels_element.set("PhysicalSizeZ", str(pixel_depth))
         pixels_element.set("PhysicalSizeZUnit", "µm")
+    samples_per_pixel = str(size_s)
     for channel_id in range(size_c):
         channel_element = ElementTree.SubElement(
             pixels_element,
             "Channel",
-            attrib={"ID": f"Channel:0:{channel_id:d}", "SamplesPerPixel": str(size_s)},
+            attrib={
+                "ID": f"Channel:0:{channel_id:d}",
+                "SamplesPerPixel": samples_per_pixel,
+            },
         )
         if channel_names is not None and channel_names[channel_id]:
             channel_element.set("Name", channel_names[channel_id])
@@ -1,22 +1,29 @@
+import math
 import sys
 import warnings
 from datetime import datetime
 from enum import Enum
-from io import BytesIO
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional, Sequence, Tuple, Union
+from typing import FrozenSet, Iterator, NamedTuple, Optional, Sequence, Tuple, Union
+from xml.etree import ElementTree
 
 import numpy as np
 import tifffile
 from tifffile import TiffWriter
 
-from xtiff.ome import get_ome_xml
+from xtiff.ome import OME_TYPES, get_ome_xml
 
 try:
     import xarray as xr  # type: ignore
 except ImportError:
     xr = None
 
+# empty tuple when xarray is not installed, making isinstance always return False
+_DATA_ARRAY_TYPES: Tuple[type, ...] = (xr.DataArray,) if xr is not None else ()
+
+_SYS_BIG_ENDIAN = sys.byteorder == "big"
+
 
 class TiffProfile(Enum):
     TIFF = 1
@@ -24,20 +31,89 @@ class TiffProfile(Enum):
     OME_TIFF = 3
 
 
+class _TiffProfilePolicy(NamedTuple):
+    supports_image_name: bool
+    forces_big_endian: bool
+    supports_compression: bool
+    supports_tiling: bool
+    supports_big_tiff: bool
+    supports_channel_names: bool
+    supports_pixel_depth: bool
+    supported_dtypes: Optional[FrozenSet[np.dtype]]
+    writes_ome_xml_header: bool
+
+
+_PROFILE_POLICIES = {
+    TiffProfile.TIFF: _TiffProfilePolicy(
+        supports_image_name=False,
+        forces_big_endian=False,
+        supports_compression=True,
+        supports_tiling=True,
+        supports_big_tiff=True,
+        supports_channel_names=False,
+        supports_pixel_depth=False,
+        supported_dtypes=None,
+        writes_ome_xml_header=False,
+    ),
+    TiffProfile.IMAGEJ: _TiffProfilePolicy(
+        supports_image_name=False,
+        forces_big_endian=True,
+        supports_compression=False,
+        supports_tiling=False,
+        supports_big_tiff=False,
+        supports_channel_names=False,
+        supports_pixel_depth=False,
+        supported_dtypes=frozenset(
+            {np.dtype(np.uint8), np.dtype(np.uint16), np.dtype(np.float32)}
+        ),
+        writes_ome_xml_header=False,
+    ),
+    TiffProfile.OME_TIFF: _TiffProfilePolicy(
+        supports_image_name=True,
+        forces_big_endian=False,
+        supports_compression=True,
+        supports_tiling=True,
+        supports_big_tiff=True,
+        supports_channel_names=True,
+        supports_pixel_depth=True,
+        supported_dtypes=frozenset(OME_TYPES),
+        writes_ome_xml_header=True,
+    ),
+}
+
+_DEFLATE_COMPRESSION_TYPES = frozenset({"adobe_deflate", "deflate", "zlib"})
+
+# compression codecs whose level range differs from the deflate-style 0-9
+_COMPRESSION_LEVEL_RANGES = {
+    "zstd": (1, 22),
+}
+
+_CHANNEL_AXES = {
+    2: None,  # YX
+    3: 0,  # CYX
+    4: 1,  # ZCYX
+    5: 2,  # TZCYX
+    6: 2,  # TZCYXS
+}
+
+
 def to_tiff(
     img,
     file,
     image_name: Union[str, bool, None] = None,
     image_date: Union[str, datetime, None] = None,
     channel_names: Union[Sequence[str], bool, None] = None,
-    description: Optional[str] = None,
+    description: Union[str, bytes, None] = None,
     profile: TiffProfile = TiffProfile.OME_TIFF,
     big_endian: Optional[bool] = None,
     big_tiff: Optional[bool] = None,
     big_tiff_threshold: int = 2**32 - 2**25,
     interleaved: bool = True,
     compression_type: Optional[str] = None,
-    compression_level: int = 0,
+    compression_level: Optional[int] = None,
+    max_workers: Optional[int] = None,
+    tile: Optional[Tuple[int, int]] = None,
+    buffer_size: int = 2**21,
     pixel_size: Optional[float] = None,
     pixel_depth: Optional[float] = None,
     software: str = "xtiff",
@@ -76,9 +152,14 @@ def to_tiff(
         multi-channel OME-TIFFs, and to the behavior for False otherwise. Only relevant
         when writing multi-channel OME-TIFF files, any value other than None or False
         will raise a warning for other TIFF profiles.
-    :param description: TIFF description tag. Will default to the OME-XML header when
-        writing OME-TIFF files. Any value other than None will raise a warning in this
-        case.
+    :param description: TIFF description tag, as string or UTF-8-encoded bytes
+        (strings are encoded as UTF-8 before writing). Defaults to the OME-XML header
+        when writing OME-TIFF files. For OME-TIFF files,
+        any value other than None is used verbatim as the OME-XML header and skips
+        OME-XML generation; it is the caller's responsibility to provide a valid
+        header matching the image. This allows pipelines writing many files with
+        identical metadata to serialize the header once (e.g. from get_ome_xml, using
+        xml.etree.ElementTree.tostring) and reuse the bytes.
     :param profile: TIFF specification of the written file.
         Supported TIFF profiles:
         - TIFF (no restrictions apply)
@@ -99,11 +180,29 @@ def to_tiff(
         available values. Compression is not supported for TiffProfile.IMAGEJ. Note:
         Compression prevents from memory-mapping images and should therefore be avoided
         when images are compressed externally, e.g. when they are stored in compressed
+        archives. It should also be avoided for high-entropy data (e.g. noisy float32
+        images), where it spends considerable time for little size reduction.
+    :param compression_level: Compression level, between 0 and 9 for most compression
+        types (between 1 and 22 for zstd). If None, defaults to 4 for deflate-based
+        compression types (which writes files only marginally larger than the usual
+        default of 6, but considerably faster) and to the codec default otherwise.
+        Compression is not supported for TiffProfile.IMAGEJ. Note: Compression
+        prevents from memory-mapping images and should therefore be avoided when
+        images are compressed externally, e.g. when they are stored in compressed
         archives.
-    :param compression_level: Compression level, between 0 and 9. Compression is not
-        supported for TiffProfile.IMAGEJ. Note: Compression prevents from memory-mapping
-        images and should therefore be avoided when images are compressed externally,
-        e.g. when they are stored in compressed archives.
+    :param max_workers: Maximum number of threads used for compressing image
+        segments. If None, the number of threads is determined by tifffile. Only
+        relevant when compression is enabled; compression codecs release the GIL, so
+        multiple threads can speed up writing large compressed images considerably.
+    :param tile: Tile shape as (height, width) tuple, e.g. (1024, 1024). If None,
+        images are stored in strips (the TIFF default). Tiled storage allows readers
+        to access spatial regions of large images without decoding whole rows and
+        enables parallel per-tile compression. Not supported for TiffProfile.IMAGEJ,
+        any value other than None will raise a warning for this profile.
+    :param buffer_size: Size in bytes of the write buffer used when file is a path.
+        Defaults to 2 MiB. Larger buffers reduce the number of system calls and can
+        speed up writing to networked storage considerably. Ignored for file-like
+        targets, which are passed to tifffile as-is.
     :param pixel_size: Planar (x/y) size of one pixel, in micrometer.
     :param pixel_depth: Depth (z size) of one pixel, in micrometer. Only relevant when
         writing OME-TIFF files, any value other than None will raise a warning for other
@@ -117,33 +216,37 @@ def to_tiff(
         function. Only relevant when writing OME-TIFF files, will raise a warning if
         provided for other TIFF profiles.
     """
+    policy = _PROFILE_POLICIES[profile]
+    img_is_data_array = _is_data_array(img)
+
     # file
     if isinstance(file, str):
         file = Path(file)
     if isinstance(file, Path):
-        if not file.suffix.lower() == ".tiff":
+        suffixes = tuple(s.lower() for s in file.suffixes)
+        if suffixes[-1:] != (".tiff",):
             warnings.warn(
                 f"The specified TIFF file name does not end with .tiff: {file.name}"
             )
-        if profile == TiffProfile.OME_TIFF:
-            if not file.name.lower().endswith(".ome.tiff"):
+        if policy.writes_ome_xml_header:
+            if suffixes[-2:] != (".ome", ".tiff"):
                 warnings.warn(
                     "The specified OME-TIFF file name "
                     f"does not end with .ome.tiff: {file.name}"
                 )
         else:
-            if file.name.lower().endswith(".ome.tiff"):
+            if suffixes[-2:] == (".ome", ".tiff"):
                 warnings.warn(
                     "The specified non-OME-TIFF file name "
                     f"ends with .ome.tiff: {file.name}"
                 )
 
     # image name
-    data_array_has_image_name = _is_data_array(img) and img.name
+    data_array_has_image_name = img_is_data_array and img.name
     if (
         image_name is None
         and (data_array_has_image_name or isinstance(file, Path))
-        and profile == TiffProfile.OME_TIFF
+        and policy.supports_image_name
     ):
         image_name = True
     if isinstance(image_name, bool):
@@ -162,13 +265,12 @@ def to_tiff(
     assert not isinstance(image_name, bool)
     if isinstance(image_name, str) and len(image_name) == 0:
         raise ValueError("Image name is empty")
-    if image_name is not None and profile != TiffProfile.OME_TIFF:
+    if image_name is not None and not policy.supports_image_name:
         warnings.warn(
             "The provided TIFF profile does not support image names, "
             "ignoring image name"
         )
         image_name = None
-    assert image_name is None or len(image_name) > 0
 
     # image date
     if image_date is None:
@@ -176,39 +278,59 @@ def to_tiff(
 
     # byte order
     if big_endian is None:
-        big_endian = (profile == TiffProfile.IMAGEJ) or sys.byteorder == "big"
-    elif profile == TiffProfile.IMAGEJ and not big_endian:
+        big_endian = policy.forces_big_endian or _SYS_BIG_ENDIAN
+    elif policy.forces_big_endian and not big_endian:
         warnings.warn(
             "The ImageJ TIFF profile does not support the specified byte order, "
             "continuing with big endian"
         )
         big_endian = True
-    assert big_endian is not None
 
     # compression
     if (
         compression_type is not None
-        and compression_type not in tifffile.TIFF.COMPRESSION()
+        and compression_type.lower() not in _get_compression_types()
     ):
         raise ValueError(
             f"The specified compression type is not supported: {compression_type}"
         )
-    if not 0 <= compression_level <= 9:
-        raise ValueError(
-            "The specified compression level is not between 0 and 9: "
-            f"{compression_level:d}"
+    if compression_level is not None:
+        min_level, max_level = (0, 9)
+        if compression_type is not None:
+            min_level, max_level = _COMPRESSION_LEVEL_RANGES.get(
+                compression_type.lower(), (0, 9)
+            )
+        if not min_level <= compression_level <= max_level:
+            raise ValueError(
+                f"The specified compression level is not between {min_level:d} and "
+                f"{max_level:d}: {compression_level:d}"
+            )
+    elif (
+        compression_type is not None
+        and compression_type.lower() in _DEFLATE_COMPRESSION_TYPES
+    ):
+        compression_level = 4
+    compression: Optional[str] = compression_type
+    if compression is None and compression_level is not None and compression_level > 0:
+        # a compression level without a compression type historically selected zlib
+        compression = "zlib"
+    compressionargs: Optional[dict] = None
+    if compression is not None and compression_level is not None:
+        compressionargs = {"level": compression_level}
+    if not policy.supports_compression and compression is not None:
+        warnings.warn(
+            "The provided TIFF profile does not support compression, "
+            "ignoring compression"
         )
-    compression: Union[int, Tuple[str, int]] = compression_level
-    if compression_type is not None:
-        compression = (compression_type, compression_level)
-    if profile == TiffProfile.IMAGEJ and compression != 0:
+        compression = None
+        compressionargs = None
+
+    # tiling
+    if tile is not None and not policy.supports_tiling:
         warnings.warn(
-            "The ImageJ TIFF profile does not support compression, ignoring compression"
+            "The provided TIFF profile does not support tiled images, ignoring tile"
         )
-        compression = 0
-    assert isinstance(compression, int) or (
-        isinstance(compression, tuple) and len(compression) == 2
-    )
+        tile = None
 
     # resolution
     resolution = None
@@ -219,7 +341,7 @@ def to_tiff(
             )
         pixels_per_centimeter = 10**4 / pixel_size
         resolution = (pixels_per_centimeter, pixels_per_centimeter, "CENTIMETER")
-    if pixel_depth is not None and profile != TiffProfile.OME_TIFF:
+    if pixel_depth is not None and not policy.supports_pixel_depth:
         warnings.warn(
             "Pixel depth information is supported for OME-TIFF only, "
             "ignoring pixel depth"
@@ -231,73 +353,59 @@ def to_tiff(
         )
 
     # convert image to numpy array or xarray DataArray
-    if not isinstance(img, np.ndarray) and not _is_data_array(img):
+    if not isinstance(img, np.ndarray) and not img_is_data_array:
         img = np.asarray(img)
-    if profile == TiffProfile.IMAGEJ and img.dtype not in (
-        np.uint8,
-        np.uint16,
-        np.float32,
-    ):
+    if policy.supported_dtypes is not None and img.dtype not in policy.supported_dtypes:
+        supported_dtypes = ", ".join(sorted(str(t) for t in policy.supported_dtypes))
         raise ValueError(
-            "The ImageJ TIFF profile does not support the specified data type: "
-            f"{img.dtype} (supported: uint8, uint16, float32)"
+            "The provided TIFF profile does not support the specified data type: "
+            f"{img.dtype} (supported: {supported_dtypes})"
         )
-    assert isinstance(img, np.ndarray) or _is_data_array(img)
 
     # determine image shape
-    channel_axis = None
-    img_shape = img.shape
-    if img.ndim == 2:  # YX
-        img_shape = (1, 1, 1, img.shape[0], img.shape[1], 1)
-    elif img.ndim == 3:  # CYX
-        channel_axis = 0
-        img_shape = (1, 1, img.shape[0], img.shape[1], img.shape[2], 1)
-    elif img.ndim == 4:  # ZCYX
-        channel_axis = 1
-        img_shape = (1, img.shape[0], img.shape[1], img.shape[2], img.shape[3], 1)
-    elif img.ndim == 5:  # TZCYX
-        channel_axis = 2
-        img_shape = (
-            img.shape[0],
-            img.shape[1],
-            img.shape[2],
-            img.shape[3],
-            img.shape[4],
-            1,
+    if img.ndim not in _CHANNEL_AXES:
+        raise ValueError(
+            f"Unsupported number of dimensions: {img.ndim:d} (supported: 2, 3, 4, 5, 6)"
         )
-    elif img.ndim == 6:  # TZCYXS
-        channel_axis = 2
+    channel_axis = _CHANNEL_AXES[img.ndim]
+    if img.ndim < 6:
+        # pad with leading T/Z/C axes and a trailing S axis to TZCYXS
+        img_shape = (1,) * (5 - img.ndim) + tuple(img.shape) + (1,)
+    else:  # TZCYXS
+        img_shape = tuple(img.shape)
         if img.shape[-1] > 1 and not interleaved:
             interleaved = True
-            if profile == TiffProfile.OME_TIFF:
+            if policy.writes_ome_xml_header:
                 warnings.warn(
                     "RGB(A) OME-TIFF images must be saved as interleaved, "
                     "ignoring interleaved parameter"
                 )
-    else:
-        raise ValueError(
-            f"Unsupported number of dimensions: {img.ndim:d} (supported: 2, 3, 4, 5, 6)"
-        )
     size_t, size_z, size_c, size_y, size_x, size_s = img_shape
     if profile == TiffProfile.IMAGEJ and size_s in (3, 4) and img.dtype != np.uint8:
         warnings.warn(
             "The ImageJ TIFF profile for RGB does not support the specified data type, "
-            "casting to uint8"
+            "clipping to [0, 255] and casting to uint8"
         )
-        img = img.astype(np.uint8)
-    assert len(img_shape) == 6
+        if img_is_data_array:
+            # keep the DataArray intact for channel name determination below
+            img = img.clip(0, 255).astype(np.uint8)
+        else:
+            # clip directly into a uint8 buffer to avoid a same-dtype intermediate
+            clipped = np.empty(img.shape, dtype=np.uint8)
+            np.clip(img, 0, 255, out=clipped, casting="unsafe")
+            img = clipped
 
     # determine channel names
     if (
         channel_names is None
-        and _is_data_array(img)
+        and img_is_data_array
         and channel_axis is not None
-        and profile == TiffProfile.OME_TIFF
+        and policy.supports_channel_names
     ):
         channel_names = True
     if isinstance(channel_names, bool):
         if channel_names:
-            if not _is_data_array(img):
+            if not img_is_data_array:
                 raise ValueError(
                     "Cannot determine channel names from non-DataArray image"
                 )
@@ -306,27 +414,39 @@ def to_tiff(
                     "Cannot determine channel names from DataArrays "
                     "without a channel dimension"
                 )
-            channel_names = img.coords[img.dims[channel_axis]].values
+            channel_names = img.coords[img.dims[channel_axis]].to_index().tolist()
         else:
             channel_names = None
     assert not isinstance(channel_names, bool)
+    if channel_names is not None:
+        # materialize to a plain list once, e.g. for numpy arrays of strings
+        channel_names = list(channel_names)
     if channel_names is not None and len(channel_names) != size_c:
         raise ValueError(
             f"Invalid number of channel names: {len(channel_names):d} "
             f"(expected: {size_c:d})"
         )
-    if channel_names is not None and profile != TiffProfile.OME_TIFF:
+    if channel_names is not None and not policy.supports_channel_names:
         warnings.warn(
             "Channel names are supported for OME-TIFF only, ignoring channel names"
         )
         channel_names = None
-    assert channel_names is None or len(channel_names) == size_c
 
     # convert image to TZCYXS numpy array
-    if _is_data_array(img):
-        img = img.values
-    img = img.reshape(img_shape)
-    assert isinstance(img, np.ndarray) and len(img.shape) == 6
+    if img_is_data_array:
+        if img.chunks is not None:
+            # keep chunked (e.g. dask-backed) DataArrays lazy; their pages are
+            # materialized one by one when writing
+            img = img.data.reshape(img_shape)
+        else:
+            img = img.values
+    if img.shape != img_shape:
+        img = img.reshape(img_shape)
+    if isinstance(img, np.ndarray) and not img.flags.c_contiguous:
+        warnings.warn(
+            "The image data is not C-contiguous and is copied for faster writing"
+        )
+        img = np.ascontiguousarray(img)
 
     # determine BigTIFF status
     if big_tiff_threshold < 0:
@@ -334,26 +454,33 @@ def to_tiff(
             f"The BigTIFF size threshold is negative: {big_tiff_threshold:d}"
         )
     if big_tiff is None:
-        big_tiff = img.size * img.itemsize > big_tiff_threshold
-    if big_tiff and profile == TiffProfile.IMAGEJ:
+        # compute from img_shape using Python integers to avoid materializing
+        # lazily-backed images and to rule out fixed-width integer overflow
+        num_bytes = math.prod(int(size) for size in img_shape)
+        num_bytes *= np.dtype(img.dtype).itemsize
+        big_tiff = num_bytes > big_tiff_threshold
+    if big_tiff and not policy.supports_big_tiff:
         warnings.warn("BigTIFF is not supported for ImageJ format, disabling BigTIFF")
         big_tiff = False
-    assert big_tiff is not None
 
     # get description tag
-    if description is not None and profile == TiffProfile.OME_TIFF:
+    if isinstance(description, str):
+        # encode up front to skip tifffile's 7-bit ASCII check, which would reject
+        # e.g. the micron (µ) character contained in get_ome_xml output
+        description = description.encode("utf-8")
+    if ome_xml_kwargs and not policy.writes_ome_xml_header:
         warnings.warn(
-            "Custom TIFF description tags are not supported for OME-TIFF, "
-            "ignoring description"
+            "Additional arguments are supported for OME-TIFF only, "
+            "ignoring additional keyword arguments"
         )
-        description = None
-    if ome_xml_kwargs and profile != TiffProfile.OME_TIFF:
+        ome_xml_kwargs = {}
+    if description is not None and policy.writes_ome_xml_header and ome_xml_kwargs:
         warnings.warn(
-            "Additional arguments are supported for OME-TIFF only, "
+            "The provided description is used as pre-generated OME-XML header, "
             "ignoring additional keyword arguments"
         )
         ome_xml_kwargs = {}
-    if profile == TiffProfile.OME_TIFF:
+    if policy.writes_ome_xml_header and description is None:
         if ome_xml_fun is None:
             raise ValueError("No function provided for generating the OME-XML")
         ome_xml = ome_xml_fun(
@@ -370,32 +497,79 @@ def to_tiff(
         # In particular, the ASCII standard does not support the micron (μ) character,
         # which is used in PhysicalSizeX/Y/Z attributes. Therefore, the OME-XML
         # Description Tag is always encoded as UTF-8.
-        with BytesIO() as description_buffer:
-            ome_xml.write(description_buffer, encoding="utf-8", xml_declaration=True)
-            # do not decode byte string to skip tifffile's ASCII check
-            description = description_buffer.getvalue()  # type: ignore
+        # Do not decode the byte string to skip tifffile's ASCII check.
+        description = ElementTree.tostring(  # type: ignore
+            ome_xml.getroot(), encoding="utf-8", xml_declaration=True
+        )
 
     # write image
+    if buffer_size <= 0:
+        raise ValueError(f"The write buffer size is not positive: {buffer_size:d}")
     byte_order = ">" if big_endian else "<"
     imagej = profile == TiffProfile.IMAGEJ
-    metadata: Optional[dict] = None if profile == TiffProfile.OME_TIFF else {}
-    with TiffWriter(
-        file, bigtiff=big_tiff, byteorder=byte_order, imagej=imagej
-    ) as writer:
-        # set photometric to 'MINISBLACK' to not treat three-channel images as RGB
-        writer.write(
-            data=img,
-            photometric="MINISBLACK",
-            compression=compression,
-            description=description,
-            datetime=image_date,
-            resolution=resolution,
-            software=software,
-            metadata=metadata,
-        )
+    metadata: Optional[dict] = None if policy.writes_ome_xml_header else {}
+    data: Union[np.ndarray, Iterator[np.ndarray]] = img
+    data_shape: Optional[Tuple[int, ...]] = None
+    data_dtype: Optional[np.dtype] = None
+    if isinstance(img, np.memmap) or not isinstance(img, np.ndarray):
+        if tile is None:
+            # stream memory-mapped and lazy (e.g. dask) images page by page instead
+            # of loading them into memory
+            data = _iter_pages(img)
+            data_shape = tuple(img.shape)
+            data_dtype = img.dtype
+        else:
+            # tifffile consumes iterator data tile by tile when tile is set, so
+            # page streaming does not apply; write tiled images in bulk instead
+            if not isinstance(img, np.ndarray):
+                img = np.asarray(img)
+            data = img
+    if isinstance(file, Path):
+        # open path targets with a large write buffer; the Python default (8 KiB)
+        # causes many small writes, which is slow on networked storage
+        file_or_handle = open(file, "wb", buffering=buffer_size)
+    else:
+        file_or_handle = file
+    try:
+        with TiffWriter(
+            file_or_handle, bigtiff=big_tiff, byteorder=byte_order, imagej=imagej
+        ) as writer:
+            # set photometric to 'MINISBLACK' to not treat three-channel images as RGB
+            writer.write(
+                data=data,
+                shape=data_shape,
+                dtype=data_dtype,
+                photometric="MINISBLACK",
+                compression=compression,
+                compressionargs=compressionargs,
+                description=description,
+                datetime=image_date,
+                resolution=resolution,
+                software=software,
+                metadata=metadata,
+                tile=tile,
+                maxworkers=max_workers,
+            )
+    finally:
+        if file_or_handle is not file:
+            file_or_handle.close()
+
+
+@lru_cache(maxsize=1)
+def _get_compression_types() -> FrozenSet[str]:
+    compression_enum = getattr(tifffile, "COMPRESSION", None)
+    if compression_enum is None:  # fall back for older tifffile versions
+        compression_enum = tifffile.TIFF.COMPRESSION()
+    # tifffile accepts 'ZLIB' as shorthand for ADOBE_DEFLATE
+    return frozenset(name.lower() for name in compression_enum.__members__) | {"zlib"}
+
+
+def _iter_pages(img) -> Iterator[np.ndarray]:
+    for t in range(img.shape[0]):
+        for z in range(img.shape[1]):
+            for c in range(img.shape[2]):
+                yield np.asarray(img[t, z, c])
 
 
 def _is_data_array(img) -> bool:
-    if xr is not None:
-        return isinstance(img, xr.DataArray)
-    return False
+    return isinstance(img, _DATA_ARRAY_TYPES)